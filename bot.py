@@ -1,9 +1,16 @@
 # bot.py
 import os
 import ssl
+import time
+import queue
+import atexit
 import asyncio
+import logging
+import logging.handlers
+import collections
+import contextlib
 import datetime as dt
-from typing import Optional
+from typing import Any, Optional
 
 import discord
 from discord import app_commands
@@ -17,6 +24,24 @@ from config import (
     FOOTER_TEXT, FOOTER_ICON
 )
 
+# ===================== LOGGING =====================
+# Handlers only enqueue; a listener thread does the blocking stdout writes.
+# discord.py's own logger shares the queue (bot.run is told not to add its handler).
+logger = logging.getLogger("securitybot")
+
+_log_queue: queue.SimpleQueue = queue.SimpleQueue()
+_log_stream = logging.StreamHandler()
+_log_stream.setFormatter(logging.Formatter("%(asctime)s %(levelname)-8s %(name)s: %(message)s"))
+_log_queue_handler = logging.handlers.QueueHandler(_log_queue)
+for _name in ("securitybot", "discord"):
+    _lg = logging.getLogger(_name)
+    _lg.setLevel(logging.INFO)
+    _lg.propagate = False
+    _lg.addHandler(_log_queue_handler)
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_stream)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
 # ===================== ENV & INTENTS =====================
 load_dotenv()
 TOKEN = os.getenv("DISCORD_TOKEN")
@@ -31,13 +56,23 @@ DB_NAME = os.getenv("DB_NAME", "discord_security")
 DB_SSL = int(os.getenv("DB_SSL", "0"))                 # 1 to enable SSL
 DB_SSL_VERIFY = int(os.getenv("DB_SSL_VERIFY", "0"))   # 1 to verify certs
 
+# Pool sizing; aiomysql opens DB_POOL_MIN connections up front in create_pool
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "3"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+
+# Ping pooled connections idle longer than this (seconds) before handing them out
+DB_PING_IDLE = int(os.getenv("DB_PING_IDLE", "60"))
+
+# Optional: share anti-spam windows across processes/shards (e.g. redis://localhost:6379/0)
+REDIS_URL = os.getenv("REDIS_URL")
+
 INTENTS = discord.Intents.default()
 INTENTS.guilds = True
 INTENTS.members = False          # needed for timeouts, kicks, bans
 INTENTS.message_content = False # we don't need content for anti-spam
 
 # Commands that require allowlist/privilege
-RESTRICTED_COMMANDS = {
+RESTRICTED_COMMANDS = frozenset({
     "shutdown",
     "reset",
     "lockdown",
@@ -48,21 +83,185 @@ RESTRICTED_COMMANDS = {
     "ban",
     "allow",
     "antispam",
-}
+})
+assert all(c == c.casefold() for c in RESTRICTED_COMMANDS)
+RESTRICTED_COMMANDS_HELP = ", ".join(sorted(RESTRICTED_COMMANDS))
+
+# Channel types whose @everyone send_messages is toggled by /lockdown
+LOCKABLE_CHANNEL_TYPES = (discord.TextChannel, discord.ForumChannel, discord.StageChannel, discord.VoiceChannel)
+
+# msg_window GC sweep period (seconds)
+MSG_WINDOW_GC_INTERVAL = 60
+
+# settings_antispam default rows are queued and written in batches this often (seconds)
+ANTISPAM_ROW_FLUSH_INTERVAL = 5
+
+# How long an owner/admin/manage_guild result is reused in is_allowed (seconds)
+PERM_CACHE_TTL = 5.0
+
+# ===================== SQL =====================
+# Every statement is a module constant so the server always sees identical text
+
+# Sent as one multi-statement script at startup
+SQL_CREATE_TABLES = """
+    CREATE TABLE IF NOT EXISTS guild_allowed_users (
+        id BIGINT PRIMARY KEY AUTO_INCREMENT,
+        guild_id BIGINT NOT NULL,
+        user_id BIGINT NOT NULL,
+        command_name VARCHAR(64) NOT NULL, -- '*' = all restricted commands
+        added_by BIGINT NOT NULL,
+        added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE KEY uniq_allow (guild_id, user_id, command_name)
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+    CREATE TABLE IF NOT EXISTS settings_antispam (
+        guild_id BIGINT PRIMARY KEY,
+        enabled TINYINT(1) NOT NULL DEFAULT 0,
+        messages INT NOT NULL DEFAULT 6,
+        per_seconds INT NOT NULL DEFAULT 4,
+        timeout_seconds INT NOT NULL DEFAULT 30,
+        KEY idx_enabled (enabled)
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+"""
+
+SQL_SELECT_ENABLED_ANTISPAM = (
+    "SELECT guild_id, enabled, messages, per_seconds, timeout_seconds "
+    "FROM settings_antispam WHERE enabled=1"
+)
+
+# Primary key only; seeds the set of guilds that already have a row
+SQL_SELECT_ANTISPAM_GUILDS = "SELECT guild_id FROM settings_antispam"
+
+SQL_INSERT_ANTISPAM_ROW = "INSERT IGNORE INTO settings_antispam (guild_id) VALUES (%s)"
+
+SQL_UPSERT_ANTISPAM_ENABLED = """
+    INSERT INTO settings_antispam (guild_id, enabled)
+    VALUES (%s, %s)
+    ON DUPLICATE KEY UPDATE enabled=VALUES(enabled)
+"""
+
+SQL_SELECT_ANTISPAM_THRESHOLDS = "SELECT messages, per_seconds, timeout_seconds FROM settings_antispam WHERE guild_id=%s"
+
+SQL_UPSERT_ANTISPAM = """
+    INSERT INTO settings_antispam (guild_id, enabled, messages, per_seconds, timeout_seconds)
+    VALUES (%s, %s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE
+        enabled=VALUES(enabled),
+        messages=VALUES(messages),
+        per_seconds=VALUES(per_seconds),
+        timeout_seconds=VALUES(timeout_seconds)
+"""
+
+# Allowlist statements; lookups are served from SecurityBot.allow_cache and
+# uniq_allow (guild_id, user_id, command_name) covers every WHERE below
+SQL_SELECT_ALLOWLIST = "SELECT guild_id, user_id, command_name FROM guild_allowed_users"
+
+SQL_INSERT_ALLOW = """
+    INSERT IGNORE INTO guild_allowed_users (guild_id, user_id, command_name, added_by)
+    VALUES (%s, %s, %s, %s)
+"""
+
+SQL_DELETE_ALLOW = """
+    DELETE FROM guild_allowed_users
+    WHERE guild_id=%s AND user_id=%s AND command_name=%s
+"""
+
+# ===================== REDIS =====================
+# Atomic sliding window per (guild, user) sorted set, scored by wall-clock time.
+# KEYS[1] = window key; ARGV = now, per_seconds, max_msgs, message id (unique member).
+# Returns 1 and resets the window when more than max_msgs fall inside per_seconds,
+# so exactly one worker acts on a given burst.
+REDIS_WINDOW_LUA = """
+redis.call('ZADD', KEYS[1], ARGV[1], ARGV[4])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', '(' .. (tonumber(ARGV[1]) - tonumber(ARGV[2])))
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+if redis.call('ZCARD', KEYS[1]) > tonumber(ARGV[3]) then
+    redis.call('DEL', KEYS[1])
+    return 1
+end
+return 0
+"""
 
 def now_utc() -> dt.datetime:
     return dt.datetime.now(tz=dt.timezone.utc)
 
+# ===================== STATIC EMBEDS =====================
+# Built once at import; copy() before changing anything per-send
+NOT_ALLOWED_EMBED = discord.Embed(
+    description="❌ You are not allowed to use this command here.",
+    color=ERROR_COLOR
+)
+NOT_ALLOWED_EMBED.set_footer(text=FOOTER_TEXT, icon_url=FOOTER_ICON)
+
+ANTISPAM_TIMEOUT_EMBED = discord.Embed(color=WARNING_COLOR)
+ANTISPAM_TIMEOUT_EMBED.set_footer(text=FOOTER_TEXT, icon_url=FOOTER_ICON)
+
+HELP_EMBED = discord.Embed(title="🛡️ Security Bot — Help", color=EMBED_COLOR)
+HELP_EMBED.add_field(
+    name="Admin/Security",
+    value=(
+        "**/lockdown** — lock all channels\n"
+        "**/unlockdown** — unlock all channels\n"
+        "**/purge <amount>** — bulk delete messages\n"
+        "**/slowmode <seconds> [#channel]** — set slowmode\n"
+        "**/kick @user [reason]** — kick user\n"
+        "**/ban @user [reason]** — ban user\n"
+        "**/shutdown** — stop the bot process\n"
+        "**/reset** — reload slash commands\n"
+    ),
+    inline=False,
+)
+HELP_EMBED.add_field(
+    name="Access Control (DB-backed)",
+    value=(
+        "**/allow add @user [command|*]** — permit user for one or all restricted commands\n"
+        "**/allow remove @user [command|*]** — remove permission\n"
+        "**/allow list [command]** — list who is allowed\n"
+        "Owner/Admin/Manage Server are always allowed."
+    ),
+    inline=False,
+)
+HELP_EMBED.add_field(
+    name="Anti-Spam",
+    value=(
+        "**/antispam on|off** — toggle\n"
+        "**/antispam_config messages per_seconds timeout_seconds** — thresholds\n"
+        "Example: 6 msgs / 4s → 30s timeout."
+    ),
+    inline=False,
+)
+HELP_EMBED.set_footer(text=FOOTER_TEXT, icon_url=FOOTER_ICON)
+
 # ===================== BOT CLASS =====================
 class SecurityBot(commands.Bot):
     def __init__(self):
         super().__init__(command_prefix="!", intents=INTENTS)
         self.db_pool: Optional[aiomysql.Pool] = None
+        # set only when REDIS_URL is configured; otherwise msg_window is used
+        # (redis.asyncio is imported lazily so it's only needed when REDIS_URL is set)
+        self.redis: Optional[Any] = None
+        self._redis_window = None
+        # True while Redis calls fail; warn once on failure and once on recovery
+        self._redis_down = False
 
         # anti-spam runtime state
-        self.msg_window: dict[tuple[int, int], list[float]] = {}
-        # guild_id -> (enabled, messages, per_seconds, timeout_seconds)
+        # (guild_id, user_id) -> last messages+1 timestamps; appends drop the oldest.
+        # Process-local on purpose. Tuple keys measured faster than a packed
+        # (gid << 64) | uid int or struct.pack bytes on CPython 3.11.
+        self.msg_window: dict[tuple[int, int], collections.deque[float]] = {}
+        # guild_id -> (enabled, messages, per_seconds, timeout_seconds); enabled guilds only
         self.antispam_cache: dict[int, tuple[bool, int, int, int]] = {}
+        # guild_id -> user_id -> allowed command names ('*' = all)
+        self.allow_cache: dict[int, dict[int, set[str]]] = {}
+        # (guild_id, user_id) -> (checked_at, is owner/admin/manage_guild)
+        self._perm_cache: dict[tuple[int, int], tuple[float, bool]] = {}
+        # guilds with enabled=1, checked first on every message
+        self.antispam_enabled_guilds: set[int] = set()
+        # guilds whose settings row exists or is queued; new ones wait in _pending_guild_rows
+        self._known_guilds: set[int] = set()
+        self._pending_guild_rows: list[int] = []
+        self._gc_task: Optional[asyncio.Task] = None
+        self._flush_task: Optional[asyncio.Task] = None
 
     async def setup_hook(self):
         # Validate env early
@@ -90,12 +289,13 @@ class SecurityBot(commands.Bot):
                 user=DB_USER,
                 password=DB_PASSWORD,
                 db=DB_NAME,
+                charset="utf8mb4",    # explicit; same as the driver default and the tables
                 autocommit=True,
-                minsize=1,
-                maxsize=5,
+                minsize=DB_POOL_MIN,  # pre-opened, so early commands skip the handshake
+                maxsize=DB_POOL_MAX,
                 connect_timeout=10,   # quicker failure if unreachable
                 ssl=ssl_ctx,          # None unless DB_SSL=1
-                pool_recycle=1800,    # recycle every 30m
+                pool_recycle=600,     # recycle every 10m, well under wait_timeout
             )
         except Exception as e:
             raise SystemExit(
@@ -105,224 +305,358 @@ class SecurityBot(commands.Bot):
                 f"and whether SSL is needed (set DB_SSL=1)."
             )
 
-        await self._create_tables()
-        await self._warm_antispam_cache()
+        await self._init_db()
+
+        if REDIS_URL:
+            try:
+                import redis.asyncio as aioredis
+            except ImportError:
+                raise SystemExit("❌ REDIS_URL is set but the 'redis' package is not installed.")
+            try:
+                self.redis = aioredis.from_url(REDIS_URL)
+                await self.redis.ping()
+            except Exception as e:
+                raise SystemExit(f"❌ Could not connect to Redis at {REDIS_URL}. Error: {type(e).__name__}: {e}")
+            self._redis_window = self.redis.register_script(REDIS_WINDOW_LUA)
+        self._gc_task = asyncio.create_task(self._gc_msg_window())
+        self._flush_task = asyncio.create_task(self._flush_guild_rows())
 
         # Sync slash commands
         try:
             await self.tree.sync()
         except Exception as e:
-            print(f"[WARN] Slash sync failed: {e}")
-
-    async def _create_tables(self):
-        sqls = [
-            """
-            CREATE TABLE IF NOT EXISTS guild_allowed_users (
-                id BIGINT PRIMARY KEY AUTO_INCREMENT,
-                guild_id BIGINT NOT NULL,
-                user_id BIGINT NOT NULL,
-                command_name VARCHAR(64) NOT NULL, -- '*' = all restricted commands
-                added_by BIGINT NOT NULL,
-                added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE KEY uniq_allow (guild_id, user_id, command_name)
-            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
-            """,
-            """
-            CREATE TABLE IF NOT EXISTS settings_antispam (
-                guild_id BIGINT PRIMARY KEY,
-                enabled TINYINT(1) NOT NULL DEFAULT 0,
-                messages INT NOT NULL DEFAULT 6,
-                per_seconds INT NOT NULL DEFAULT 4,
-                timeout_seconds INT NOT NULL DEFAULT 30
-            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
-            """,
-        ]
-        assert self.db_pool is not None
-        async with self.db_pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                for s in sqls:
-                    await cur.execute(s)
+            logger.warning("Slash sync failed: %s", e)
 
-    async def _warm_antispam_cache(self):
+    @contextlib.asynccontextmanager
+    async def db_acquire(self):
+        """Pool checkout that pings (and reconnects) connections left idle too long."""
         assert self.db_pool is not None
         async with self.db_pool.acquire() as conn:
+            if conn.loop.time() - conn.last_usage > DB_PING_IDLE:
+                await conn.ping(reconnect=True)
+            yield conn
+
+    async def close(self):
+        for task in (self._gc_task, self._flush_task):
+            if task:
+                task.cancel()
+        if self.redis is not None:
+            await self.redis.aclose()
+        await super().close()
+
+    async def _gc_msg_window(self):
+        # windows are only reset on a timeout, so prune idle users periodically.
+        # A window quiet for longer than its guild's per_seconds can never trigger
+        # again (the next message alone spans too much), and disabled guilds
+        # aren't cached at all, so both are safe to drop.
+        while not self.is_closed():
+            await asyncio.sleep(MSG_WINDOW_GC_INTERVAL)
+            now = time.monotonic()
+            dead = []
+            for key, w in self.msg_window.items():
+                settings = self.antispam_cache.get(key[0])
+                if not w or settings is None or now - w[-1] > settings[2]:
+                    dead.append(key)
+            for k in dead:
+                self.msg_window.pop(k, None)
+
+            stale = [k for k, (t, _) in self._perm_cache.items() if now - t >= PERM_CACHE_TTL]
+            for k in stale:
+                self._perm_cache.pop(k, None)
+
+    async def _init_db(self):
+        """Create tables and warm the antispam + allowlist caches on one connection."""
+        async with self.db_acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.execute(
-                    "SELECT guild_id, enabled, messages, per_seconds, timeout_seconds FROM settings_antispam"
-                )
-                rows = await cur.fetchall()
-        for gid, enabled, msgs, per_s, to_s in rows:
+                # one round trip for all DDL (aiomysql enables MULTI_STATEMENTS);
+                # drain every result so a failing statement raises here
+                await cur.execute(SQL_CREATE_TABLES)
+                while await cur.nextset():
+                    pass
+
+                # disabled guilds stay uncached; on_message skips them anyway
+                await cur.execute(SQL_SELECT_ENABLED_ANTISPAM)
+                antispam_rows = await cur.fetchall()
+
+                await cur.execute(SQL_SELECT_ANTISPAM_GUILDS)
+                known_rows = await cur.fetchall()
+
+                await cur.execute(SQL_SELECT_ALLOWLIST)
+                allow_rows = await cur.fetchall()
+
+        for gid, enabled, msgs, per_s, to_s in antispam_rows:
             self.antispam_cache[int(gid)] = (bool(enabled), int(msgs), int(per_s), int(to_s))
+            self.antispam_enabled_guilds.add(int(gid))
+        self._known_guilds.update(int(gid) for (gid,) in known_rows)
+        for gid, uid, cmd in allow_rows:
+            self.cache_allow(int(gid), int(uid), cmd)
 
-    async def ensure_guild_antispam_row(self, guild_id: int):
-        if guild_id in self.antispam_cache:
+    def cache_allow(self, guild_id: int, user_id: int, command_name: str):
+        self.allow_cache.setdefault(guild_id, {}).setdefault(user_id, set()).add(command_name)
+
+    def uncache_allow(self, guild_id: int, user_id: int, command_name: str):
+        users = self.allow_cache.get(guild_id)
+        if not users or user_id not in users:
             return
-        assert self.db_pool is not None
-        async with self.db_pool.acquire() as conn:
+        users[user_id].discard(command_name)
+        if not users[user_id]:
+            del users[user_id]
+        if not users:
+            del self.allow_cache[guild_id]
+
+    async def upsert_antispam(
+        self,
+        guild_id: int,
+        *,
+        enabled: bool,
+        messages: Optional[int] = None,
+        per_seconds: Optional[int] = None,
+        timeout_seconds: Optional[int] = None,
+    ):
+        """Write anti-spam settings; the cache is updated only once the DB write succeeds.
+
+        Thresholds are all-or-nothing: omit them to toggle ``enabled`` alone.
+        """
+        prev = self.antispam_cache.get(guild_id)
+        if messages is None or per_seconds is None or timeout_seconds is None:
+            sql, args = SQL_UPSERT_ANTISPAM_ENABLED, (guild_id, int(enabled))
+            new = (enabled, prev[1], prev[2], prev[3]) if prev else None
+        else:
+            sql = SQL_UPSERT_ANTISPAM
+            args = (guild_id, int(enabled), messages, per_seconds, timeout_seconds)
+            new = (enabled, int(messages), int(per_seconds), int(timeout_seconds))
+        async with self.db_acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(sql, args)
+                if enabled and new is None:
+                    # disabled guilds aren't cached; load their stored thresholds
+                    await cur.execute(SQL_SELECT_ANTISPAM_THRESHOLDS, (guild_id,))
+                    msgs, per_s, to_s = await cur.fetchone()
+                    new = (True, int(msgs), int(per_s), int(to_s))
+        if enabled:
+            self.antispam_cache[guild_id] = new
+            self.antispam_enabled_guilds.add(guild_id)
+        else:
+            self.antispam_cache.pop(guild_id, None)
+            self.antispam_enabled_guilds.discard(guild_id)
+
+    async def ensure_guild_antispam_rows(self, guild_ids: list[int]):
+        """Create default (disabled) settings rows; existing rows are left alone."""
+        if not guild_ids:
+            return
+        # one multi-row INSERT (aiomysql rewrites executemany for VALUES lists)
+        async with self.db_acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.execute(
-                    "INSERT IGNORE INTO settings_antispam (guild_id) VALUES (%s)",
-                    (guild_id,),
-                )
-        self.antispam_cache[guild_id] = (False, 6, 4, 30)
+                await cur.executemany(SQL_INSERT_ANTISPAM_ROW, [(gid,) for gid in guild_ids])
+
+    def queue_guild_antispam_rows(self, guild_ids: list[int]):
+        """Queue default rows for guilds not seen yet; _flush_guild_rows writes them."""
+        for gid in guild_ids:
+            if gid not in self._known_guilds:
+                self._known_guilds.add(gid)
+                self._pending_guild_rows.append(gid)
+
+    async def _flush_guild_rows(self):
+        while not self.is_closed():
+            await asyncio.sleep(ANTISPAM_ROW_FLUSH_INTERVAL)
+            if not self._pending_guild_rows:
+                continue
+            batch, self._pending_guild_rows = self._pending_guild_rows, []
+            try:
+                await self.ensure_guild_antispam_rows(batch)
+            except Exception as e:
+                # keep them queued for the next pass
+                self._pending_guild_rows.extend(batch)
+                logger.warning("Flushing %d settings row(s) failed: %s", len(batch), e)
 
     async def is_allowed(self, interaction: discord.Interaction, command_name: str) -> bool:
-        """Owner/Admin/Manage Guild OR allowlisted in DB for command or '*'."""
+        """Owner/Admin/Manage Guild OR allowlisted (cached from DB) for command or '*'."""
         if not interaction.guild or not interaction.user:
             return False
 
-        # Owner always allowed
-        if interaction.guild.owner_id == interaction.user.id:
-            return True
-
-        # Elevated perms allowed
-        member: discord.Member = interaction.user  # type: ignore
-        if member.guild_permissions.administrator or member.guild_permissions.manage_guild:
+        # Owner / elevated perms always allowed (briefly cached per member)
+        key = (interaction.guild.id, interaction.user.id)
+        now = time.monotonic()
+        hit = self._perm_cache.get(key)
+        if hit and now - hit[0] < PERM_CACHE_TTL:
+            elevated = hit[1]
+        else:
+            member: discord.Member = interaction.user  # type: ignore
+            perms = member.guild_permissions
+            elevated = (
+                interaction.guild.owner_id == interaction.user.id
+                or perms.administrator
+                or perms.manage_guild
+            )
+            self._perm_cache[key] = (now, elevated)
+        if elevated:
             return True
 
-        # DB allowlist
-        assert self.db_pool is not None
-        async with self.db_pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(
-                    """
-                    SELECT 1
-                    FROM guild_allowed_users
-                    WHERE guild_id=%s AND user_id=%s AND (command_name=%s OR command_name='*')
-                    LIMIT 1
-                    """,
-                    (interaction.guild.id, interaction.user.id, command_name.lower()),
-                )
-                row = await cur.fetchone()
-                return row is not None
+        # Allowlist (kept in sync with the DB by /allow add|remove)
+        cmds = self.allow_cache.get(interaction.guild.id, {}).get(interaction.user.id)
+        return bool(cmds and (command_name in cmds or "*" in cmds))
 
 bot = SecurityBot()
 
 # ===================== CHECK DECORATOR FOR SLASH =====================
 def require_allowed(command_name: str):
+    command_name = command_name.casefold()  # normalise once, not per invocation
+    # a False result raises CheckFailure, answered in on_app_command_error
     async def predicate(interaction: discord.Interaction) -> bool:
-        allowed = await bot.is_allowed(interaction, command_name)
-        if allowed:
-            return True
+        return await bot.is_allowed(interaction, command_name)
+    return app_commands.check(predicate)
+
+@bot.tree.error
+async def on_app_command_error(interaction: discord.Interaction, error: app_commands.AppCommandError):
+    if isinstance(error, app_commands.CheckFailure):
         # Nice error embed
-        embed = discord.Embed(
-            description="❌ You are not allowed to use this command here.",
-            color=ERROR_COLOR
-        )
-        embed.set_footer(text=FOOTER_TEXT, icon_url=FOOTER_ICON)
         try:
-            await interaction.response.send_message(embed=embed, ephemeral=True)
+            await interaction.response.send_message(embed=NOT_ALLOWED_EMBED, ephemeral=True)
         except discord.InteractionResponded:
-            await interaction.followup.send(embed=embed, ephemeral=True)
-        return False
-    return app_commands.check(predicate)
+            await interaction.followup.send(embed=NOT_ALLOWED_EMBED, ephemeral=True)
+        return
+    command = interaction.command.name if interaction.command else "?"
+    logger.error("Ignoring exception in command %r", command, exc_info=error)
 
 # ===================== EVENTS =====================
 @bot.event
 async def on_ready():
     activity = discord.Activity(type=discord.ActivityType.watching, name="/help")
     await bot.change_presence(status=discord.Status.online, activity=activity)
-    print(f"✅ Logged in as {bot.user} | {len(bot.guilds)} guild(s)")
+    # settings rows for every guild, written in one batch by the flush task
+    bot.queue_guild_antispam_rows([g.id for g in bot.guilds])
+    logger.info("✅ Logged in as %s | %d guild(s)", bot.user, len(bot.guilds))
 
 @bot.event
 async def on_guild_join(guild: discord.Guild):
-    await bot.ensure_guild_antispam_row(guild.id)
+    # batched with any other joins by the flush task
+    bot.queue_guild_antispam_rows([guild.id])
+
+@bot.event
+async def on_guild_role_update(before: discord.Role, after: discord.Role):
+    # role permission edits can demote/promote anyone; drop that guild's cached checks
+    if before.permissions != after.permissions:
+        for key in [k for k in bot._perm_cache if k[0] == after.guild.id]:
+            bot._perm_cache.pop(key, None)
 
 @bot.event
 async def on_message(message: discord.Message):
-    # anti-spam without reading content
-    if message.author.bot or not message.guild:
+    # anti-spam without reading content.
+    # Fast path first: most guilds never turn anti-spam on, so one set lookup
+    # rejects the bulk of messages before any other attribute access.
+    guild = message.guild
+    if guild is None or guild.id not in bot.antispam_enabled_guilds or message.author.bot:
         return
 
-    gid = message.guild.id
+    gid = guild.id
     uid = message.author.id
-    await bot.ensure_guild_antispam_row(gid)
-    enabled, max_msgs, per_seconds, timeout_seconds = bot.antispam_cache.get(gid, (False, 6, 4, 30))
-    if not enabled:
-        return
+    _, max_msgs, per_seconds, timeout_seconds = bot.antispam_cache[gid]
 
-    now = now_utc().timestamp()
-    key = (gid, uid)
-    window = bot.msg_window.get(key, [])
-    window.append(now)
-    # keep only recent
-    cutoff = now - per_seconds
-    window = [t for t in window if t >= cutoff]
-    bot.msg_window[key] = window
-
-    if len(window) > max_msgs:
+    spam = None
+    if bot._redis_window is not None:
+        # shared window: one round trip, atomic across every worker
+        try:
+            spam = bool(await bot._redis_window(
+                keys=[f"as:{gid}:{uid}"],
+                args=[time.time(), per_seconds, max_msgs, message.id],
+            ))
+        except Exception as e:
+            if not bot._redis_down:
+                bot._redis_down = True
+                logger.warning("Redis anti-spam check failed, using local window until it recovers: %s", e)
+        else:
+            if bot._redis_down:
+                bot._redis_down = False
+                logger.info("Redis anti-spam check recovered")
+
+    if spam is None:
+        # window only needs relative times; monotonic avoids datetime allocations
+        now = time.monotonic()
+        key = (gid, uid)
+        window = bot.msg_window.get(key)
+        if window is None or window.maxlen != max_msgs + 1:
+            # new user or thresholds changed since the window was created
+            window = bot.msg_window[key] = collections.deque(maxlen=max_msgs + 1)
+        window.append(now)
+
+        # max_msgs+1 messages inside per_seconds -> spam
+        spam = len(window) == window.maxlen and window[-1] - window[0] <= per_seconds
+        if spam:
+            window.clear()
+
+    if spam:
+        member: discord.Member = message.author  # type: ignore
+        until = now_utc() + dt.timedelta(seconds=timeout_seconds)
+        embed = ANTISPAM_TIMEOUT_EMBED.copy()
+        embed.description = f"⛔ {member.mention} has been timed out for **{timeout_seconds}s** (anti-spam)."
+
+        # announce only once the timeout has actually been applied
         try:
-            member: discord.Member = message.author  # type: ignore
-            until = now_utc() + dt.timedelta(seconds=timeout_seconds)
             await member.edit(timed_out_until=until, reason=f"Auto anti-spam: >{max_msgs}/{per_seconds}s")
-
-            embed = discord.Embed(
-                description=f"⛔ {member.mention} has been timed out for **{timeout_seconds}s** (anti-spam).",
-                color=WARNING_COLOR
-            )
-            embed.set_footer(text=FOOTER_TEXT, icon_url=FOOTER_ICON)
             await message.channel.send(embed=embed, silent=True)
-
-            bot.msg_window[key] = []
         except Exception as e:
-            print(f"[WARN] Anti-spam timeout failed: {e}")
+            logger.warning("Anti-spam timeout failed: %s", e)
 
 # ===================== HELPERS =====================
+def chunk_lines(lines: list[str], limit: int = 1900) -> list[str]:
+    """Join lines with newlines into blocks no longer than limit characters."""
+    blocks: list[str] = []
+    buf: list[str] = []
+    size = 0
+    for line in lines:
+        if buf and size + 1 + len(line) > limit:
+            blocks.append("\n".join(buf))
+            buf, size = [], 0
+        size += len(line) + (1 if buf else 0)
+        buf.append(line)
+    if buf:
+        blocks.append("\n".join(buf))
+    return blocks
+
 async def set_everyone_send_perms(guild: discord.Guild, allow: bool):
     overwrite_key = guild.default_role
+    reason = "Lockdown" if not allow else "Unlockdown"
+
+    # Guild permissions are OR-ed across a member's roles, so flipping the @everyone
+    # role only locks the guild when no other role grants send_messages. In that
+    # case one role edit covers every channel without its own @everyone overwrite.
+    role_edited = False
+    if not any(r.permissions.send_messages for r in guild.roles if not r.is_default()):
+        perms = discord.Permissions(overwrite_key.permissions.value)
+        perms.send_messages = allow
+        try:
+            await overwrite_key.edit(permissions=perms, reason=reason)
+            role_edited = True
+        except Exception as e:
+            logger.warning("Editing @everyone in guild %s failed: %s", guild.id, e)
+
+    # Per-channel edits only where an explicit @everyone send_messages overwrite
+    # contradicts the role (or everywhere if the role wasn't edited), capped to
+    # spare the rate limiter
+    sem = asyncio.Semaphore(5)
+
+    async def _apply(ch: discord.abc.GuildChannel, ow: discord.PermissionOverwrite):
+        async with sem:
+            await ch.set_permissions(overwrite_key, overwrite=ow, reason=reason)
+
     tasks: list[asyncio.Task] = []
     for ch in guild.channels:
-        if isinstance(ch, (discord.TextChannel, discord.ForumChannel, discord.StageChannel, discord.VoiceChannel)):
-            ow = ch.overwrites_for(overwrite_key)
-            ow.send_messages = True if allow else False
-            try:
-                tasks.append(asyncio.create_task(
-                    ch.set_permissions(overwrite_key, overwrite=ow, reason="Lockdown" if not allow else "Unlockdown")
-                ))
-            except Exception:
-                pass
+        if not isinstance(ch, LOCKABLE_CHANNEL_TYPES):
+            continue
+        ow = ch.overwrites_for(overwrite_key)
+        if role_edited and ow.send_messages is None:
+            continue  # inherits the role's new value
+        if ow.send_messages is allow:
+            continue  # already in the target state, skip the REST call
+        ow.send_messages = allow
+        tasks.append(asyncio.create_task(_apply(ch, ow)))
     if tasks:
         await asyncio.gather(*tasks, return_exceptions=True)
 
 # ===================== SLASH COMMANDS =====================
 @bot.tree.command(description="Show help for security & moderation commands.")
 async def help(interaction: discord.Interaction):
-    embed = discord.Embed(title="🛡️ Security Bot — Help", color=EMBED_COLOR)
-    embed.add_field(
-        name="Admin/Security",
-        value=(
-            "**/lockdown** — lock all channels\n"
-            "**/unlockdown** — unlock all channels\n"
-            "**/purge <amount>** — bulk delete messages\n"
-            "**/slowmode <seconds> [#channel]** — set slowmode\n"
-            "**/kick @user [reason]** — kick user\n"
-            "**/ban @user [reason]** — ban user\n"
-            "**/shutdown** — stop the bot process\n"
-            "**/reset** — reload slash commands\n"
-        ),
-        inline=False,
-    )
-    embed.add_field(
-        name="Access Control (DB-backed)",
-        value=(
-            "**/allow add @user [command|*]** — permit user for one or all restricted commands\n"
-            "**/allow remove @user [command|*]** — remove permission\n"
-            "**/allow list [command]** — list who is allowed\n"
-            "Owner/Admin/Manage Server are always allowed."
-        ),
-        inline=False,
-    )
-    embed.add_field(
-        name="Anti-Spam",
-        value=(
-            "**/antispam on|off** — toggle\n"
-            "**/antispam_config messages per_seconds timeout_seconds** — thresholds\n"
-            "Example: 6 msgs / 4s → 30s timeout."
-        ),
-        inline=False,
-    )
-    embed.set_footer(text=FOOTER_TEXT, icon_url=FOOTER_ICON)
-    await interaction.response.send_message(embed=embed, ephemeral=True)
+    await interaction.response.send_message(embed=HELP_EMBED, ephemeral=True)
 
 # ---- Access Control
 @bot.tree.command(name="allow", description="Manage who can run restricted commands (stored in DB).")
@@ -347,78 +681,80 @@ async def allow_cmd(
         return await interaction.response.send_message("Guild only.", ephemeral=True)
 
     action_v = action.value
-    command_name = (command or "*").lower()
+    command_name = (command or "*").strip().casefold()
 
     if action_v in ("add", "remove") and user is None:
         return await interaction.response.send_message("Please select a user.", ephemeral=True)
 
     if command_name != "*" and command_name not in RESTRICTED_COMMANDS:
         return await interaction.response.send_message(
-            f"Unknown command `{command_name}`. Try one of: {', '.join(sorted(RESTRICTED_COMMANDS))} or `*`.",
+            f"Unknown command `{command_name}`. Try one of: {RESTRICTED_COMMANDS_HELP} or `*`.",
             ephemeral=True,
         )
 
-    assert bot.db_pool is not None
-    async with bot.db_pool.acquire() as conn:
-        async with conn.cursor() as cur:
-            if action_v == "add":
-                await cur.execute(
-                    """
-                    INSERT IGNORE INTO guild_allowed_users (guild_id, user_id, command_name, added_by)
-                    VALUES (%s, %s, %s, %s)
-                    """,
-                    (interaction.guild.id, user.id, command_name, interaction.user.id),
-                )
-                embed = discord.Embed(
-                    description=f"✅ {user.mention} is now allowed to use `{command_name}`.",
-                    color=SUCCESS_COLOR
-                )
-                embed.set_footer(text=FOOTER_TEXT, icon_url=FOOTER_ICON)
-                return await interaction.response.send_message(embed=embed, ephemeral=True)
-
-            if action_v == "remove":
-                await cur.execute(
-                    """
-                    DELETE FROM guild_allowed_users
-                    WHERE guild_id=%s AND user_id=%s AND command_name=%s
-                    """,
-                    (interaction.guild.id, user.id, command_name),
-                )
-                embed = discord.Embed(
-                    description=f"🗑️ Removed permission `{command_name}` from {user.mention}.",
-                    color=WARNING_COLOR
-                )
-                embed.set_footer(text=FOOTER_TEXT, icon_url=FOOTER_ICON)
-                return await interaction.response.send_message(embed=embed, ephemeral=True)
-
-            # list
-            if command_name == "*":
-                await cur.execute(
-                    "SELECT user_id, command_name FROM guild_allowed_users WHERE guild_id=%s ORDER BY user_id",
-                    (interaction.guild.id,),
-                )
-            else:
-                await cur.execute(
-                    """
-                    SELECT user_id, command_name
-                    FROM guild_allowed_users
-                    WHERE guild_id=%s AND (command_name=%s OR command_name='*')
-                    ORDER BY user_id
-                    """,
-                    (interaction.guild.id, command_name),
-                )
-            rows = await cur.fetchall()
-            if not rows:
-                return await interaction.response.send_message("No entries.", ephemeral=True)
-            lines = [f"<@{uid}> — `{cmd}`" for uid, cmd in rows]
-
-            embed = discord.Embed(
-                title="Allowed Users",
-                description="\n".join(lines),
-                color=EMBED_COLOR
-            )
-            embed.set_footer(text=FOOTER_TEXT, icon_url=FOOTER_ICON)
+    if action_v in ("add", "remove"):
+        async with bot.db_acquire() as conn:
+            async with conn.cursor() as cur:
+                if action_v == "add":
+                    await cur.execute(
+                        SQL_INSERT_ALLOW,
+                        (interaction.guild.id, user.id, command_name, interaction.user.id),
+                    )
+                    bot.cache_allow(interaction.guild.id, user.id, command_name)
+                    embed = discord.Embed(
+                        description=f"✅ {user.mention} is now allowed to use `{command_name}`.",
+                        color=SUCCESS_COLOR
+                    )
+                    embed.set_footer(text=FOOTER_TEXT, icon_url=FOOTER_ICON)
+                    return await interaction.response.send_message(embed=embed, ephemeral=True)
+
+                if action_v == "remove":
+                    await cur.execute(
+                        SQL_DELETE_ALLOW,
+                        (interaction.guild.id, user.id, command_name),
+                    )
+                    bot.uncache_allow(interaction.guild.id, user.id, command_name)
+                    embed = discord.Embed(
+                        description=f"🗑️ Removed permission `{command_name}` from {user.mention}.",
+                        color=WARNING_COLOR
+                    )
+                    embed.set_footer(text=FOOTER_TEXT, icon_url=FOOTER_ICON)
+                    return await interaction.response.send_message(embed=embed, ephemeral=True)
+
+    # list (served from the cache, which mirrors guild_allowed_users)
+    users = bot.allow_cache.get(interaction.guild.id, {})
+    rows = [
+        (uid, cmd)
+        for uid in sorted(users)
+        for cmd in sorted(users[uid])
+        if command_name == "*" or cmd in (command_name, "*")
+    ]
+    if not rows:
+        return await interaction.response.send_message("No entries.", ephemeral=True)
+    lines = [f"<@{uid}> — `{cmd}`" for uid, cmd in rows]
+
+    # page long lists so a big allowlist doesn't get the whole reply rejected
+    for i, block in enumerate(chunk_lines(lines)):
+        embed = discord.Embed(
+            title="Allowed Users" if i == 0 else None,
+            description=block,
+            color=EMBED_COLOR
+        )
+        embed.set_footer(text=FOOTER_TEXT, icon_url=FOOTER_ICON)
+        if i == 0:
             await interaction.response.send_message(embed=embed, ephemeral=True)
+        else:
+            await interaction.followup.send(embed=embed, ephemeral=True)
+
+@allow_cmd.autocomplete("command")
+async def allow_command_autocomplete(interaction: discord.Interaction, current: str):
+    # suggest valid names client-side so typos never reach the command
+    current = current.strip().casefold()
+    return [
+        app_commands.Choice(name=c, value=c)
+        for c in ("*", *sorted(RESTRICTED_COMMANDS))
+        if c.startswith(current)
+    ][:25]
 
 # ---- Security / Moderation
 @bot.tree.command(description="Lock all channels for @everyone.")
@@ -426,7 +762,7 @@ async def allow_cmd(
 async def lockdown(interaction: discord.Interaction):
     if not interaction.guild:
         return await interaction.response.send_message("Guild only.", ephemeral=True)
-    await interaction.response.send_message("🔒 Locking all channels…", ephemeral=True)
+    await interaction.response.defer(ephemeral=True, thinking=True)
     await set_everyone_send_perms(interaction.guild, allow=False)
     embed = discord.Embed(
         description="✅ Lockdown enabled. Only roles with explicit overrides can speak.",
@@ -440,7 +776,7 @@ async def lockdown(interaction: discord.Interaction):
 async def unlockdown(interaction: discord.Interaction):
     if not interaction.guild:
         return await interaction.response.send_message("Guild only.", ephemeral=True)
-    await interaction.response.send_message("🔓 Unlocking all channels…", ephemeral=True)
+    await interaction.response.defer(ephemeral=True, thinking=True)
     await set_everyone_send_perms(interaction.guild, allow=True)
     embed = discord.Embed(
         description="✅ Lockdown disabled.",
@@ -456,7 +792,7 @@ async def purge(interaction: discord.Interaction, amount: app_commands.Range[int
     channel = interaction.channel
     if not isinstance(channel, discord.TextChannel):
         return await interaction.response.send_message("Use in a text channel.", ephemeral=True)
-    await interaction.response.send_message(f"🧹 Deleting {amount} messages…", ephemeral=True)
+    await interaction.response.defer(ephemeral=True, thinking=True)
     deleted = await channel.purge(limit=amount)
     embed = discord.Embed(
         description=f"✅ Deleted {len(deleted)} messages.",
@@ -523,20 +859,7 @@ async def antispam(interaction: discord.Interaction, state: app_commands.Choice[
     if not interaction.guild:
         return await interaction.response.send_message("Guild only.", ephemeral=True)
     enabled = (state.value == "on")
-    assert bot.db_pool is not None
-    async with bot.db_pool.acquire() as conn:
-        async with conn.cursor() as cur:
-            await cur.execute(
-                """
-                INSERT INTO settings_antispam (guild_id, enabled)
-                VALUES (%s, %s)
-                ON DUPLICATE KEY UPDATE enabled=VALUES(enabled)
-                """,
-                (interaction.guild.id, int(enabled)),
-            )
-    # keep cache in sync
-    prev = bot.antispam_cache.get(interaction.guild.id, (False, 6, 4, 30))
-    bot.antispam_cache[interaction.guild.id] = (enabled, prev[1], prev[2], prev[3])
+    await bot.upsert_antispam(interaction.guild.id, enabled=enabled)
     color = SUCCESS_COLOR if enabled else WARNING_COLOR
     embed = discord.Embed(
         description=f"✅ Anti-spam **{'enabled' if enabled else 'disabled'}**.",
@@ -560,22 +883,13 @@ async def antispam_config(
 ):
     if not interaction.guild:
         return await interaction.response.send_message("Guild only.", ephemeral=True)
-    assert bot.db_pool is not None
-    async with bot.db_pool.acquire() as conn:
-        async with conn.cursor() as cur:
-            await cur.execute(
-                """
-                INSERT INTO settings_antispam (guild_id, enabled, messages, per_seconds, timeout_seconds)
-                VALUES (%s, 1, %s, %s, %s)
-                ON DUPLICATE KEY UPDATE
-                    messages=VALUES(messages),
-                    per_seconds=VALUES(per_seconds),
-                    timeout_seconds=VALUES(timeout_seconds),
-                    enabled=1
-                """,
-                (interaction.guild.id, messages, per_seconds, timeout_seconds),
-            )
-    bot.antispam_cache[interaction.guild.id] = (True, int(messages), int(per_seconds), int(timeout_seconds))
+    await bot.upsert_antispam(
+        interaction.guild.id,
+        enabled=True,
+        messages=messages,
+        per_seconds=per_seconds,
+        timeout_seconds=timeout_seconds,
+    )
     embed = discord.Embed(
         description=f"🔧 Anti-spam set to **{messages}/{per_seconds}s → {timeout_seconds}s timeout**.",
         color=SUCCESS_COLOR
@@ -608,12 +922,10 @@ async def shutdown(interaction: discord.Interaction):
 
 # ===================== RUN =====================
 if __name__ == "__main__":
-    bot.run(TOKEN)
-
-
-@bot.event
-async def on_ready():
-    activity = discord.Activity(type=discord.ActivityType.watching, name="/help")
-    await bot.change_presence(status=discord.Status.online, activity=activity)
-    print(f"✅ Logged in as {bot.user} | {len(bot.guilds)} guild(s)")
-   
+    # uvloop (libuv) is a faster drop-in event loop; not available on Windows
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
+    bot.run(TOKEN, log_handler=None)